@@ -8,11 +8,13 @@ Features:
 - Prevents data loss for queues > 10 items.
 - intelligently switches to single file send if queue has only 1 item.
 """
-from collections import defaultdict
 import os
+import sys
 import asyncio
 
+from aiolimiter import AsyncLimiter
 from pyrogram import Client, filters
+from pyrogram.errors import FloodWait, InternalServerError
 from config import *
 from pyrogram.types import (
     InputMediaPhoto,
@@ -23,165 +25,360 @@ from pyrogram.types import (
 # App
 app = Client("album_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
-# In-memory store: user_id -> list of items
-# Each item: {"type": "photo"|"video", "file_id": str, "caption": Optional[str]}
-pending = defaultdict(list)
-# Timers: user_id -> asyncio.Task
-timers = {}
-# Send locks so we don't send multiple albums concurrently for same user
-send_locks = defaultdict(asyncio.Lock)
 
-
-def _make_input_media(item, with_caption=False):
-    typ = item.get("type")
-    file_id = item.get("file_id")
-    caption = item.get("caption") if with_caption else None
-
-    if typ == "photo":
-        return InputMediaPhoto(media=file_id, caption=caption)
-    elif typ == "video":
-        return InputMediaVideo(media=file_id, caption=caption)
+class Item:
+    """A queued media item."""
+    __slots__ = ("type", "file_id", "caption", "media_obj")
+
+    def __init__(self, typ: str, file_id: str, caption=None, media_obj=None):
+        self.type = typ  # "photo" | "video"
+        self.file_id = file_id
+        self.caption = caption
+        self.media_obj = media_obj  # InputMediaPhoto | InputMediaVideo, built once
+
+
+# Private-chat media the bot can put into an album
+MEDIA_FILTER = filters.private & (filters.photo | filters.video | filters.animation | filters.document)
+
+# Document mime major type -> queued media type
+MIME_MAJOR_TO_TYPE = {"image": "photo", "video": "video"}
+
+# In-memory store: user_id -> list of Item
+pending: dict[int, list] = {}
+# Items taken off the queue but not yet sent: user_id -> count
+in_flight: dict[int, int] = {}
+# Users with a send running; at most one per user keeps albums in order
+senders: set[int] = set()
+# Users who ran /cancel while a send was running; the rest of it is dropped
+cancelled: set[int] = set()
+# Retry state after transient failures: user_id -> attempts so far, and
+# user_id -> loop time before which no send should start
+retries: dict[int, int] = {}
+retry_at: dict[int, float] = {}
+# Timers: user_id -> asyncio.TimerHandle
+timers: dict[int, asyncio.TimerHandle] = {}
+# Striped send locks guarding each user's queue; a fixed pool keeps memory
+# flat no matter how many users show up (colliding users just share a lock)
+LOCK_STRIPES = 64
+_stripes = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+# Telegram allows ~30 msg/s per bot; keep some headroom
+GLOBAL_TG = AsyncLimiter(25, 1)
+# Send failures worth retrying later; anything else drops the batch
+TRANSIENT_ERRORS = (asyncio.TimeoutError, OSError, FloodWait, InternalServerError)
+# Strong references to background tasks so they aren't garbage collected
+_tasks: set[asyncio.Task] = set()
+
+
+def _on_task_done(task: asyncio.Task):
+    """Forgets a finished background task and logs its failure, if any."""
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task %s failed", task.get_name(), exc_info=task.exception())
+
+
+def _spawn(coro, name=None) -> asyncio.Task:
+    """Runs a coroutine in the background, keeping the task alive until done."""
+    task = asyncio.create_task(coro, name=name)
+    _tasks.add(task)
+    task.add_done_callback(_on_task_done)
+    return task
+
+
+def _lock_for(user_id: int) -> asyncio.Lock:
+    """Returns the lock stripe guarding a user's queue."""
+    return _stripes[user_id % LOCK_STRIPES]
+
+
+def _release_in_flight(user_id: int, count: int):
+    """Stops counting items that were sent, dropped or put back in the queue."""
+    left = in_flight.get(user_id, 0) - count
+    if left > 0:
+        in_flight[user_id] = left
     else:
-        raise ValueError("Unsupported media type")
+        in_flight.pop(user_id, None)
 
 
 def _cancel_timer(user_id: int):
     """Cancels the existing timer for a user if it exists."""
-    task = timers.pop(user_id, None)
-    if task and not task.done():
-        task.cancel()
+    handle = timers.pop(user_id, None)
+    if handle:
+        handle.cancel()
+
+
+def _on_timer(client: Client, user_id: int, chat_id: int):
+    """Timer callback: auto-sends the queue once the user has gone quiet."""
+    timers.pop(user_id, None)
+    # The timer was never set to fire before a pending retry time
+    retry_at.pop(user_id, None)
+    # Only send if items exist
+    if pending.get(user_id):
+        _spawn(send_album_for_user(client, user_id, chat_id), name=f"send-{user_id}")
 
 
 def _start_timer(client: Client, user_id: int, chat_id: int):
-    """Start (or restart) inactivity timer for auto-send."""
+    """
+    Start (or restart) inactivity timer for auto-send.
+    Never fires before a pending retry time, so new media can't cut a backoff short.
+    """
     _cancel_timer(user_id)
+    loop = asyncio.get_running_loop()
+    delay = AUTO_SEND_DELAY
+    if user_id in retry_at:
+        delay = max(delay, retry_at[user_id] - loop.time())
+    timers[user_id] = loop.call_later(delay, _on_timer, client, user_id, chat_id)
+
+
+def _schedule_retry(client: Client, user_id: int, chat_id: int, error: Exception):
+    """Backs off after a transient failure before the unsent items are retried."""
+    attempts = retries.get(user_id, 0) + 1
+    retries[user_id] = attempts
+    if isinstance(error, FloodWait):
+        # Telegram says how long to stay away; retrying earlier extends the ban
+        delay = max(AUTO_SEND_DELAY, error.value)
+    else:
+        delay = AUTO_SEND_DELAY * 2 ** (attempts - 1)
+    retry_at[user_id] = asyncio.get_running_loop().time() + delay
+    _start_timer(client, user_id, chat_id)
+    logger.info("Retrying send for user %d in %.1fs (attempt %d)", user_id, delay, attempts)
+
+
+def _clear_retry(user_id: int):
+    """Forgets the retry state of a user."""
+    retries.pop(user_id, None)
+    retry_at.pop(user_id, None)
+
+
+async def _send_chunk(client: Client, user_id: int, chat_id: int, chunk: list):
+    """Sends up to 10 items as a single message or as an album."""
+    # SCENARIO A: Single Item (Cannot use send_media_group)
+    if len(chunk) == 1:
+        item = chunk[0]
+        typ = item.type
+        file_id = item.file_id
+        caption = item.caption
+        
+        async with GLOBAL_TG:
+            if typ == "photo":
+                await asyncio.wait_for(
+                    client.send_photo(chat_id, file_id, caption=caption), TG_SEND_TIMEOUT
+                )
+            elif typ == "video":
+                await asyncio.wait_for(
+                    client.send_video(chat_id, file_id, caption=caption), TG_SEND_TIMEOUT
+                )
+        logger.info("Sent single item for user %d", user_id)
+
+    # SCENARIO B: Album (2-10 items)
+    else:
+        media = [item.media_obj for item in chunk]
+        # Attach caption only to the first item (or customize logic here)
+        media[0].caption = chunk[0].caption
 
-    async def _wait_and_send():
-        try:
-            await asyncio.sleep(AUTO_SEND_DELAY)
-            # Only send if items exist
-            if pending.get(user_id):
-                await send_album_for_user(client, user_id, chat_id)
-        except asyncio.CancelledError:
-            return
-        except Exception:
-            logger.exception(f"Error in auto-send timer for user {user_id}")
+        async with GLOBAL_TG:
+            await asyncio.wait_for(
+                client.send_media_group(chat_id=chat_id, media=media), TG_SEND_TIMEOUT
+            )
+        logger.info("Sent album for user %d with %d items", user_id, len(media))
 
-    task = asyncio.create_task(_wait_and_send())
-    timers[user_id] = task
+
+async def _send_batches(client: Client, user_id: int, chat_id: int, to_send: list):
+    """
+    Sends items in batches of 10 (Telegram limit), one after another so
+    albums arrive in order. Stops at the first transient failure and returns
+    the items that weren't sent with that error; batches Telegram rejects
+    are dropped.
+    """
+    start = 0
+    try:
+        for start in range(0, len(to_send), 10):
+            if user_id in cancelled:
+                # /cancel during the upload: drop what hasn't gone out yet
+                _release_in_flight(user_id, len(to_send) - start)
+                return [], None
+            chunk = to_send[start:start + 10]
+            try:
+                await _send_chunk(client, user_id, chat_id, chunk)
+            except TRANSIENT_ERRORS as e:
+                logger.warning("Transient error sending media for user %d", user_id, exc_info=True)
+                return to_send[start:], e
+            except Exception as e:
+                # Permanent (e.g. a file Telegram rejects): drop the batch and go on
+                logger.exception("Failed to send media for user %d", user_id)
+                try:
+                    async with GLOBAL_TG:
+                        await client.send_message(chat_id, f"Failed to send media: `{e}`")
+                except Exception:
+                    pass
+            _release_in_flight(user_id, len(chunk))
+    except BaseException:
+        # Cancelled mid-send: the rest is gone, stop counting it
+        _release_in_flight(user_id, len(to_send) - start)
+        raise
+    return [], None
 
 
 async def send_album_for_user(client: Client, user_id: int, chat_id: int):
     """
     Sends pending items. 
-    - Takes first 10 items.
+    - Splits the queue into batches of 10 and sends them in order.
     - If 1 item: sends as single message.
     - If >1 items: sends as album.
-    - If >10 items originally: keeps remainder in queue and restarts timer.
+    - Keeps sending while a full album's worth is queued; a smaller
+      remainder waits for the timer.
+    - Transient failures (timeouts, flood waits, network errors) keep the
+      unsent batches at the front of the queue and retry them after a
+      backoff, up to MAX_SEND_RETRIES times; batches Telegram rejects
+      outright, or that run out of retries, are dropped and reported.
+
+    Only one send runs per user at a time, so albums can't overtake each
+    other. The lock only guards the queue itself, so new media can be
+    queued while an upload is in flight.
     """
-    async with send_locks[user_id]:
-        items = pending.get(user_id, [])
-        if not items:
-            return
-
-        # 1. Slice the batch (Telegram limit is 10)
-        to_send = items[:10]
-        remaining = items[10:]
-
-        try:
-            # SCENARIO A: Single Item (Cannot use send_media_group)
-            if len(to_send) == 1:
-                item = to_send[0]
-                typ = item["type"]
-                file_id = item["file_id"]
-                caption = item["caption"]
-                
-                if typ == "photo":
-                    await client.send_photo(chat_id, file_id, caption=caption)
-                elif typ == "video":
-                    await client.send_video(chat_id, file_id, caption=caption)
-                logger.info(f"Sent single item for user {user_id}")
-
-            # SCENARIO B: Album (2-10 items)
+    if user_id in senders:
+        # The running sender picks up whatever gets queued meanwhile
+        return
+    if user_id in retry_at and retry_at[user_id] > asyncio.get_running_loop().time():
+        # Still backing off; the timer sends once the retry time has passed
+        _start_timer(client, user_id, chat_id)
+        return
+    senders.add(user_id)
+    try:
+        lock = _lock_for(user_id)
+        unsent = []
+        error = None
+        first = True
+        while True:
+            async with lock:
+                items = pending.get(user_id)
+                if not items or (not first and len(items) < AUTO_SEND_THRESHOLD):
+                    break
+
+                # 1. Take the whole queue, keeping the same list for new items
+                to_send = items[:]
+                items.clear()
+                # A /cancel only applies to what was queued before it
+                cancelled.discard(user_id)
+                # Still counts against MAX_PENDING_PER_USER until it's out
+                in_flight[user_id] = in_flight.get(user_id, 0) + len(to_send)
+
+            # 2. Send it
+            first = False
+            unsent, error = await _send_batches(client, user_id, chat_id, to_send)
+            if unsent:
+                break
+
+        # 3. Handle State after sending
+        gave_up = None
+        async with lock:
+            if unsent and user_id in cancelled:
+                # The user cleared the queue meanwhile; don't bring it back
+                _release_in_flight(user_id, len(unsent))
+                unsent = []
+            elif unsent and retries.get(user_id, 0) >= MAX_SEND_RETRIES:
+                # Out of retries: drop the failing batch like a permanent error
+                gave_up = error
+                _release_in_flight(user_id, len(unsent[:10]))
+                unsent = unsent[10:]
+                retries.pop(user_id, None)
+            if unsent:
+                # Put unsent batches back in front of anything queued meanwhile
+                pending.setdefault(user_id, [])[:0] = unsent
+                _release_in_flight(user_id, len(unsent))
+            elif gave_up is None:
+                _clear_retry(user_id)
+            remaining = pending.get(user_id)
+            if remaining and unsent and gave_up is None:
+                _schedule_retry(client, user_id, chat_id, error)
+            elif remaining:
+                # Restart timer to allow user to add more to the next batch, 
+                # or auto-send the remainder after the delay.
+                _start_timer(client, user_id, chat_id)
+                logger.info("User %d has %d items remaining. Timer restarted.", user_id, len(remaining))
             else:
-                media = []
-                for i, item in enumerate(to_send):
-                    # Attach caption only to the first item (or customize logic here)
-                    media.append(_make_input_media(item, with_caption=(i == 0)))
-
-                await client.send_media_group(chat_id=chat_id, media=media)
-                logger.info(f"Sent album for user {user_id} with {len(media)} items")
+                # Queue is empty
+                pending.pop(user_id, None)
+                _cancel_timer(user_id)
+                _clear_retry(user_id)
 
-        except Exception as e:
-            logger.exception(f"Failed to send media for user {user_id}")
+        if gave_up is not None:
+            logger.error("Giving up on media for user %d after %d retries", user_id, MAX_SEND_RETRIES)
             try:
-                await client.send_message(chat_id, f"Failed to send media: `{e}`")
+                async with GLOBAL_TG:
+                    # Timeouts have no message of their own
+                    reason = str(gave_up) or type(gave_up).__name__
+                    await client.send_message(chat_id, f"Failed to send media: `{reason}`")
             except Exception:
                 pass
+    finally:
+        senders.discard(user_id)
+        cancelled.discard(user_id)
 
-        # 2. Handle State after sending
-        if remaining:
-            # Update pending with what's left
-            pending[user_id] = remaining
-            # Restart timer to allow user to add more to the next batch, 
-            # or auto-send the remainder after the delay.
-            _start_timer(client, user_id, chat_id)
-            logger.info(f"User {user_id} has {len(remaining)} items remaining. Timer restarted.")
-        else:
-            # Queue is empty
-            pending.pop(user_id, None)
-            _cancel_timer(user_id)
-
-
-@app.on_message(filters.private & (filters.photo | filters.video | filters.animation | filters.document))
+
+@app.on_message(MEDIA_FILTER)
 async def collect_media(client: Client, message: Message):
     user_id = message.from_user.id
     chat_id = message.chat.id
 
+    photo = message.photo
+    video = message.video
+    anim = message.animation
+    doc = message.document
+
     # 1. Detect Media Type
-    if message.photo:
-        file_id = message.photo.file_id
+    if photo:
+        file_id = photo.file_id
         typ = "photo"
-    elif message.video:
-        file_id = message.video.file_id
+    elif video:
+        file_id = video.file_id
         typ = "video"
-    elif message.animation:
-        file_id = message.animation.file_id
+    elif anim:
+        file_id = anim.file_id
         typ = "video"
-    elif message.document:
-        mime = message.document.mime_type or ""
-        file_id = message.document.file_id
-        if mime.startswith("image/"):
-            typ = "photo"
-        elif mime.startswith("video/"):
-            typ = "video"
-        else:
-            await message.reply_text("Unsupported document type. Please send images or videos.")
+    elif doc:
+        mime = doc.mime_type or ""
+        file_id = doc.file_id
+        typ = MIME_MAJOR_TO_TYPE.get(mime.partition("/")[0])
+        if typ is None:
+            async with GLOBAL_TG:
+                await message.reply_text("Unsupported document type. Please send images or videos.")
             return
     else:
         return
 
+    # Share one string object for identical file_ids (forwards, reposts)
+    file_id = sys.intern(file_id)
+
+    if len(pending.get(user_id, [])) + in_flight.get(user_id, 0) >= MAX_PENDING_PER_USER:
+        async with GLOBAL_TG:
+            await message.reply_text("Queue full, wait for current album to send.")
+        return
+
     caption = message.caption or None
+    media_obj = InputMediaPhoto(file_id) if typ == "photo" else InputMediaVideo(file_id)
 
     # 2. Add to Queue
-    pending[user_id].append({"type": typ, "file_id": file_id, "caption": caption})
-    total = len(pending[user_id])
+    queue = pending.setdefault(user_id, [])
+    queue.append(Item(typ, file_id, caption, media_obj))
+    total = len(queue)
 
     # 3. Check Threshold or Start Timer
     if total >= AUTO_SEND_THRESHOLD:
         _cancel_timer(user_id)
-        await send_album_for_user(client, user_id, chat_id)
+        # Don't hold up the update handler (and other users) on the upload
+        _spawn(send_album_for_user(client, user_id, chat_id), name=f"send-{user_id}")
     else:
         _start_timer(client, user_id, chat_id)
         
         # UX Fix: Only reply on the FIRST item to avoid spamming.
-        if total == 1:
-            await message.reply_text(
-                f"**Album started!**\n"
-                f"Send more photos/videos to group them.\n"
-                f"Auto-sending after {AUTO_SEND_DELAY}s of silence.",
-                quote=True
-            )
+        # An album still uploading means this one isn't the first.
+        if total == 1 and not in_flight.get(user_id):
+            async with GLOBAL_TG:
+                await message.reply_text(
+                    f"**Album started!**\n"
+                    f"Send more photos/videos to group them.\n"
+                    f"Auto-sending after {AUTO_SEND_DELAY}s of silence.",
+                    quote=True
+                )
 
 
 @app.on_message(filters.private & filters.command("send_album"))
@@ -195,35 +392,44 @@ async def send_album_command(client: Client, message: Message):
 @app.on_message(filters.private & filters.command("cancel"))
 async def cancel_queue(client: Client, message: Message):
     user_id = message.from_user.id
-    if user_id in pending:
+    if pending.get(user_id) or in_flight.get(user_id):
         pending.pop(user_id, None)
         _cancel_timer(user_id)
-        await message.reply_text("❌ Album queue cleared.")
+        retries.pop(user_id, None)
+        if user_id in senders:
+            # Stop the running send from finishing or requeueing the old queue
+            cancelled.add(user_id)
+        async with GLOBAL_TG:
+            await message.reply_text("❌ Album queue cleared.")
     else:
-        await message.reply_text("Queue is already empty.")
+        async with GLOBAL_TG:
+            await message.reply_text("Queue is already empty.")
 
 
 @app.on_message(filters.private & filters.command("status"))
 async def status(client: Client, message: Message):
     user_id = message.from_user.id
-    total = len(pending.get(user_id, []))
-    await message.reply_text(f"📁 Current queue: **{total}** items.")
+    # Items being uploaded still count, same as for MAX_PENDING_PER_USER
+    total = len(pending.get(user_id, [])) + in_flight.get(user_id, 0)
+    async with GLOBAL_TG:
+        await message.reply_text(f"📁 Current queue: **{total}** items.")
 
 
 @app.on_message(filters.private & filters.command("start"))
 async def start(client: Client, message: Message):
     # First send the photo
-    await message.reply_photo(
-        photo="https://i.ibb.co/QjdgRJG4/Neo-Matrix90.jpg",  # Replace with your image URL
-        caption="👋 **Hi!**\n\n"
-                "Send me photos or videos. I will group them into an album automatically.\n\n"
-                f"• **Threshold:** `{AUTO_SEND_THRESHOLD} items`\n"
-                f"• **Delay:** `{AUTO_SEND_DELAY} seconds`\n\n"
-                "Commands:\n"
-                "/send_album - Force send now\n"
-                "/cancel - Clear queue\n"
-                "/status - Check queue"
-    )
+    async with GLOBAL_TG:
+        await message.reply_photo(
+            photo="https://i.ibb.co/QjdgRJG4/Neo-Matrix90.jpg",  # Replace with your image URL
+            caption="👋 **Hi!**\n\n"
+                    "Send me photos or videos. I will group them into an album automatically.\n\n"
+                    f"• **Threshold:** `{AUTO_SEND_THRESHOLD} items`\n"
+                    f"• **Delay:** `{AUTO_SEND_DELAY} seconds`\n\n"
+                    "Commands:\n"
+                    "/send_album - Force send now\n"
+                    "/cancel - Clear queue\n"
+                    "/status - Check queue"
+        )
 
 
 if __name__ == "__main__":
@@ -28,3 +28,21 @@ try:
     AUTO_SEND_DELAY = float(os.environ.get("AUTO_SEND_DELAY", "3"))
 except ValueError:
     AUTO_SEND_DELAY = 3.0
+
+# Max items a single user may have queued at once
+try:
+    MAX_PENDING_PER_USER = int(os.environ.get("MAX_PENDING_PER_USER", "200"))
+except ValueError:
+    MAX_PENDING_PER_USER = 200
+
+# Seconds to wait for Telegram to accept an upload before retrying
+try:
+    TG_SEND_TIMEOUT = float(os.environ.get("TG_SEND_TIMEOUT", "60"))
+except ValueError:
+    TG_SEND_TIMEOUT = 60.0
+
+# Retries for a batch hit by timeouts, flood waits or network errors before it's dropped
+try:
+    MAX_SEND_RETRIES = int(os.environ.get("MAX_SEND_RETRIES", "5"))
+except ValueError:
+    MAX_SEND_RETRIES = 5